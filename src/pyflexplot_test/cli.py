@@ -119,7 +119,7 @@ def check_for_active_venv(ctx: Context) -> None:
 )
 @click.option(
     "--num-procs",
-    help="number of parallel processes during plotting",
+    help="number of parallel processes during plotting and plot comparison",
     type=int,
     default=1,
 )
@@ -170,6 +170,14 @@ def check_for_active_venv(ctx: Context) -> None:
     ),
     multiple=True,
 )
+@click.option(
+    "--refresh-tags/--cached-tags",
+    help=(
+        "obtain the remote tags used to determine the default --old-rev afresh"
+        " instead of reusing those cached during the last few minutes"
+    ),
+    default=False,
+)
 @click.option(
     "--repo",
     "repo_url",
@@ -266,6 +274,7 @@ def cli(
     presets_old_new: Sequence[Tuple[str, str]],
     old_rev: Optional[str],
     presets: Sequence[str],
+    refresh_tags: bool,
     reuse_installs: bool,
     reuse_new_install: Optional[bool],
     reuse_old_install: Optional[bool],
@@ -323,7 +332,7 @@ def cli(
     if old_rev is None:
         if cfg.verbose:
             print(f"obtain old_rev from repo {cfg.repo_url}")
-        tags = git_get_remote_tags(cfg.repo_url)
+        tags = git_get_remote_tags(cfg.repo_url, refresh=refresh_tags)
         if cfg.verbose:
             sel_tags = tags if len(tags) <= 7 else tags[:3] + ["..."] + tags[-3:]
             print(f"select most recent of {len(tags)} tags ({', '.join(sel_tags)})")
@@ -462,14 +471,14 @@ def run_in_work_dir(
         print(f"DBG:{_name_}: prepare plot configs")
     old_plot_cfg = PlotConfig(
         data_path=old_data_path,
-        infiles=old_infiles,
-        presets=old_presets,
+        infiles=tuple(old_infiles),
+        presets=tuple(old_presets),
         reuse=reuse_cfg.old_plots,
     )
     new_plot_cfg = PlotConfig(
         data_path=new_data_path,
-        infiles=new_infiles,
-        presets=new_presets,
+        infiles=tuple(new_infiles),
+        presets=tuple(new_presets),
         reuse=reuse_cfg.new_plots,
     )
 
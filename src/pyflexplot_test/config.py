@@ -3,10 +3,10 @@
 import dataclasses as dc
 from pathlib import Path
 from typing import Optional
-from typing import Sequence
+from typing import Tuple
 
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class RunConfig:
     num_procs: int
     only: Optional[int]
@@ -32,7 +32,7 @@ class ReuseConfig:
     new_plots: bool = False
 
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class WorkDirConfig:
     """Working directory config.
 
@@ -52,16 +52,16 @@ class WorkDirConfig:
     replace: bool = False
 
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class InstallConfig:
     path: Path
     rev: str
     reuse: bool
 
 
-@dc.dataclass
+@dc.dataclass(frozen=True)
 class PlotConfig:
     data_path: Optional[Path]
-    infiles: Sequence[Path]
-    presets: Sequence[str]
+    infiles: Tuple[Path, ...]
+    presets: Tuple[str, ...]
     reuse: bool
@@ -1,17 +1,19 @@
 """Main module."""
 # Standard library
 import os
-import shutil
 from pathlib import Path
 from typing import Optional
 
 # Third-party
 from git import Repo
+from git.exc import GitCommandError
 from git.exc import InvalidGitRepositoryError
 
 # Local
 from .config import InstallConfig
 from .config import RunConfig
+from .utils import is_file_or_nonempty_dir
+from .utils import remove_in_background
 from .utils import run_cmd
 
 
@@ -22,7 +24,7 @@ def prepare_clone(repo: str, install_cfg: InstallConfig, cfg: RunConfig) -> Repo
     if cfg.debug:
         print(f"DBG:{_name_}: prepare clone at {clone_path}")
     clone: Optional[Repo] = None
-    if clone_path.exists():
+    if os.path.lexists(clone_path):
         clone = handle_existing_clone(repo, install_cfg, cfg)
         if install_cfg.reuse and clone is not None:
             if cfg.debug:
@@ -32,17 +34,51 @@ def prepare_clone(repo: str, install_cfg: InstallConfig, cfg: RunConfig) -> Repo
         if cfg.debug:
             print(f"DBG:{_name_}: clone fresh repo {repo} to {clone_path}")
         clone_path.mkdir(parents=True, exist_ok=True)
-        clone = Repo.clone_from(repo, clone_path)
+        # Skip the checkout of the default branch and fetch file contents only
+        # on demand, i.e., only those of the rev checked out below
+        clone = Repo.clone_from(
+            repo, clone_path, multi_options=["--filter=blob:none", "--no-checkout"]
+        )
     assert clone is not None  # mypy
     if cfg.debug:
         print(f"DBG:{_name_}: check out rev: {install_cfg.rev}")
-    clone.git.fetch(all=True)
-    clone.git.checkout(install_cfg.rev)
-    if not clone.head.is_detached:
-        clone.git.pull()
+    # The fresh clone already contains all branches and tags, so a fetch is
+    # only necessary for revs it cannot resolve (e.g., other refs)
+    commit = resolve_rev(clone, install_cfg.rev)
+    if commit is not None:
+        clone.git.checkout(commit, detach=True)
+        return clone
+    try:
+        # Fetch only the requested rev and check it out as a detached head
+        clone.git.fetch("origin", install_cfg.rev)
+    except GitCommandError:
+        # Revs that cannot be fetched by name, e.g., abbreviated commit hashes
+        if cfg.debug:
+            print(
+                f"DBG:{_name_}: fetch all refs because rev cannot be fetched directly"
+            )
+        clone.git.fetch("origin")
+        clone.git.checkout(install_cfg.rev, detach=True)
+    else:
+        clone.git.checkout("FETCH_HEAD", detach=True)
     return clone
 
 
+def resolve_rev(clone: Repo, rev: str) -> Optional[str]:
+    """Resolve a branch, tag or commit to a commit hash in a clone, if possible.
+
+    Branches are resolved via their remote-tracking branch in order to obtain
+    the state of the remote rather than that of a local branch.
+
+    """
+    for name in [f"origin/{rev}", rev]:
+        try:
+            return clone.git.rev_parse(f"{name}^{{commit}}", verify=True)
+        except GitCommandError:
+            continue
+    return None
+
+
 def handle_existing_clone(
     repo: str, install_cfg: InstallConfig, cfg: RunConfig
 ) -> Optional[Repo]:
@@ -83,13 +119,10 @@ def handle_existing_clone(
                     " but won't because --reuse-installs (or equivalent) has not been"
                     " passed"
                 )
-    is_file_or_not_empty = not install_cfg.path.is_dir() or any(
-        install_cfg.path.iterdir()
-    )
-    if is_file_or_not_empty:
+    if is_file_or_nonempty_dir(install_cfg.path):
         if cfg.debug:
             print(f"DBG:{_name_}: remove existing clone at {install_cfg.path}")
-        shutil.rmtree(install_cfg.path)
+        remove_in_background(install_cfg.path)
     return None
 
 
@@ -97,17 +130,16 @@ def install_exe(
     clone_path: Path, reuse: bool, cfg: RunConfig, exe: str = "pyflexplot"
 ) -> Path:
     """Install pyflexplot into a virtual env and return the executable path."""
-    os.chdir(clone_path)
-    if not Path("Makefile").exists():
-        raise Exception(f"missing Makefile in {os.path.abspath(os.curdir)}")
+    if not (clone_path / "Makefile").exists():
+        raise Exception(f"missing Makefile in {clone_path.resolve()}")
     venv_path = "venv"
-    bin_path = Path(venv_path).resolve() / "bin"
+    bin_path = (clone_path / venv_path).resolve() / "bin"
     exe_path = bin_path / exe
     if reuse and exe_path.exists():
         print(f"reuse existing executable {exe_path}")
         return exe_path
     cmd_args = ["make", "install", "CHAIN=1", f"VENV_DIR={venv_path}"]
-    for line in run_cmd(cmd_args, real_time=True):
+    for line in run_cmd(cmd_args, real_time=True, cwd=clone_path):
         if cfg.verbose:
             print(line)
     if not (bin_path / "python").exists():
@@ -1,11 +1,16 @@
 """Create plots."""
 # Standard library
+import hashlib
+import json
 import os
-import re
-import shutil
 import sys
+from concurrent.futures import FIRST_EXCEPTION
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
-from typing import Iterator
+from typing import Iterable
 from typing import List
 from typing import Optional
 from typing import Sequence
@@ -15,53 +20,132 @@ from typing import Tuple
 from .config import PlotConfig
 from .config import RunConfig
 from .config import WorkDirConfig
+from .utils import CmdGroup
+from .utils import filter_existing
+from .utils import image_list_args
+from .utils import is_file_or_nonempty_dir
+from .utils import join_cmd_args
+from .utils import remove_in_background
 from .utils import run_cmd
+from .utils import run_cmd_bytes
+from .utils import run_cmd_bytes_bulk
+
+# Separator in lines printed by pyflexplot for each plot: "<infile> -> <plot>"
+PLOT_LINE_SEP = b" -> "
+
+# Directory in the work dir where the results of dry runs are cached
+DRY_RUN_CACHE_DIR = ".dry_run_cache"
 
 
 def prepare_work_path(wdir_cfg: WorkDirConfig, cfg: RunConfig) -> None:
     _name_ = "main.prepare_work_path"
     path = wdir_cfg.path
-    if path.exists() and any(path.iterdir()):
+    if is_file_or_nonempty_dir(path):
         if wdir_cfg.reuse:
             if cfg.debug:
                 print(f"DBG:{_name_}: reuse old work dir at {path}")
         else:
             if cfg.debug:
                 print(f"DBG:{_name_}: remove old work dir at {path}")
-            shutil.rmtree(path)
+            remove_in_background(path)
     path.mkdir(parents=True, exist_ok=True)
 
 
 def create_plots(
     exe_path: Path, work_path: Path, plot_cfg: PlotConfig, cfg: RunConfig
 ) -> List[Path]:
-    """Create plots for multiple presets with one call per preset."""
-    plot_paths: List[Path] = []
-    for preset, infile in zip_presets_infiles(plot_cfg):
-        plot_paths.extend(
-            create_plots_for_preset(exe_path, work_path, preset, infile, plot_cfg, cfg)
+    """Create plots for multiple presets with one call per preset.
+
+    The presets are run concurrently if ``cfg.num_procs`` allows it, with the
+    number of concurrent pyflexplot runs times the number of processes per run
+    capped at the number of CPUs. As the presets share the work dir, they are
+    only run concurrently if the dry runs show that they produce distinct
+    plots; otherwise, they are run one after another such that plots written
+    by multiple presets are overwritten in order as before.
+
+    """
+    _name_ = "main.create_plots"
+    presets_infiles = zip_presets_infiles(plot_cfg)
+    num_procs = max(1, cfg.num_procs)
+    n_workers = max(
+        1,
+        min(
+            len(presets_infiles),
+            num_procs,
+            (os.cpu_count() or 1) // num_procs,
+        ),
+    )
+    # Link the data path once for all presets as they share the work path
+    if plot_cfg.data_path:
+        link_data_path(plot_cfg.data_path, work_path, cfg)
+    # Dry runs don't write any plots, so they can always run concurrently
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        runs = list(
+            executor.map(
+                prepare_preset_run,
+                repeat(exe_path),
+                repeat(work_path),
+                [preset for preset, _ in presets_infiles],
+                [infile for _, infile in presets_infiles],
+                repeat(plot_cfg),
+                repeat(cfg),
+            )
         )
+    if n_workers > 1:
+        names_sets = [set(expected_plot_names) for _, expected_plot_names in runs]
+        if len(set().union(*names_sets)) < sum(map(len, names_sets)):
+            if cfg.verbose:
+                print(
+                    "presets produce some of the same plots; create plots for"
+                    " one preset at a time"
+                )
+            n_workers = 1
+    if cfg.debug:
+        print(
+            f"DBG:{_name_}: create plots for {len(presets_infiles)} presets with"
+            f" {n_workers} concurrent pyflexplot runs"
+        )
+    plot_paths: List[Path] = []
+    cmd_group = CmdGroup()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                create_plots_for_preset,
+                cmd_args,
+                expected_plot_names,
+                work_path,
+                plot_cfg,
+                cfg,
+                progress_counter=(n_workers == 1),
+                cmd_group=cmd_group,
+            )
+            for cmd_args, expected_plot_names in runs
+        ]
+        # Upon the first error, cancel the presets not yet started and terminate
+        # the running ones, which would otherwise be waited for before leaving
+        # the executor and thus before the error shows
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [f for f in futures if f in done and f.exception() is not None]
+        if failed:
+            for future in futures:
+                future.cancel()
+            cmd_group.terminate()
+            failed[0].result()
+        for future in futures:
+            plot_paths.extend(future.result())
     return plot_paths
 
 
-# pylint: disable=R0912  # too-many-branches (>12)
 # pylint: disable=R0913  # too-many-arguments (>5)
-# pylint: disable=R0914  # too-many-locals (>15)
-# pylint: disable=R0915  # too-many-statements (>50)
-def create_plots_for_preset(
+def prepare_preset_run(
     exe_path: Path,
     work_path: Path,
     preset: str,
     infile: Optional[Path],
     plot_cfg: PlotConfig,
     cfg: RunConfig,
-) -> List[Path]:
-    """Create plots for an individual preset."""
-    _name_ = "main.create_plots_for_preset"
-    os.chdir(work_path)
-    if plot_cfg.data_path:
-        link_data_path(plot_cfg.data_path, cfg)
-
+) -> Tuple[List[str], List[str]]:
+    """Get the command for a preset and the plots expected from a dry run."""
     cmd_args = [
         str(exe_path),
         "--no-show-version",
@@ -77,12 +161,50 @@ def create_plots_for_preset(
     cmd_args += [f"--num-procs={cfg.num_procs}"]
 
     # Perform dry-run to obtain the plots that will be produced
-    expected_plot_names = perform_dry_run(cmd_args_dry, cfg)
+    if plot_cfg.reuse:
+        deps = [exe_path] + ([infile] if infile else [])
+        expected_plot_names = perform_dry_run_cached(
+            cmd_args_dry, deps, work_path, cfg, data_path=plot_cfg.data_path
+        )
+    else:
+        expected_plot_names = perform_dry_run(cmd_args_dry, work_path, cfg)
+    if not expected_plot_names:
+        raise Exception("zero expected plots detected during dry run")
+    return cmd_args, expected_plot_names
+
+
+# pylint: disable=R0912  # too-many-branches (>12)
+# pylint: disable=R0913  # too-many-arguments (>5)
+# pylint: disable=R0914  # too-many-locals (>15)
+# pylint: disable=R0915  # too-many-statements (>50)
+def create_plots_for_preset(
+    cmd_args: List[str],
+    expected_plot_names: List[str],
+    work_path: Path,
+    plot_cfg: PlotConfig,
+    cfg: RunConfig,
+    progress_counter: bool = True,
+    cmd_group: Optional[CmdGroup] = None,
+) -> List[Path]:
+    """Create plots for an individual preset.
+
+    The command ``cmd_args`` and the ``expected_plot_names`` are obtained with
+    ``prepare_preset_run``.
+
+    Unless ``progress_counter`` is false, e.g., because multiple presets are
+    run concurrently, progress is shown as a counter updated in-place when
+    writing to a terminal.
+
+    The pyflexplot run is added to ``cmd_group``, if any, such that it can be
+    terminated if another preset fails.
+
+    """
+    _name_ = "main.create_plots_for_preset"
     expected_plot_paths = [work_path / name for name in expected_plot_names]
+    expected_plot_paths_set = set(expected_plot_paths)
     n_plots = len(expected_plot_names)
-    if n_plots == 0:
-        raise Exception("zero expected plots detected during dry run")
-    n_existing = sum(map(Path.exists, expected_plot_paths))
+    existing_plot_paths = filter_existing(expected_plot_paths)
+    n_existing = len(existing_plot_paths)
     if cfg.debug:
         print(
             f"DBG:{_name_}: found {n_existing}/{n_plots} expected plots in"
@@ -106,50 +228,60 @@ def create_plots_for_preset(
                 f"recompute all plots because only {n_existing}/{n_plots} expected"
                 f" plots already exist in {work_path}/"
             )
-            for path in expected_plot_paths:
-                if not path.exists():
-                    if cfg.debug:
-                        print(f"DBG:{_name_}: skip non-existing {path}")
-                else:
-                    if cfg.debug:
-                        print(f"DBG:{_name_}: remove {path}")
-                    path.unlink()
+            for path in existing_plot_paths:
+                if cfg.debug:
+                    print(f"DBG:{_name_}: remove {path}")
+                path.unlink()
 
     # Perform actual run, using the number of plots to show progress
     print(f"create {n_plots} plots in {work_path}:")
-    print(f"$ {' '.join(cmd_args)}")
+    print(f"$ {join_cmd_args(cmd_args)}")
     plot_paths: List[Path] = []
     i_plot = 0
-    for i_line, line in enumerate(run_cmd(cmd_args, real_time=True)):
-        if cfg.debug:
-            print(f"DBG:{_name_}: line {i_line}: {line}")
+    last_pct = -1
+    # Evaluate per-run settings once rather than for each line of output
+    debug = cfg.debug
+    show_lines = cfg.verbose or not progress_counter or not sys.stdout.isatty()
+    # Lines are only decoded when needed as most are not about plots
+    for i_line, line in enumerate(
+        run_cmd_bytes(cmd_args, cwd=work_path, group=cmd_group)
+    ):
+        if debug:
+            print(f"DBG:{_name_}: line {i_line}: {line.decode('utf-8')}")
         plot_name = parse_line_for_plot_name(line, cfg)
         if not plot_name:
             continue
         plot_path = work_path / plot_name
         plot_paths.append(plot_path)
-        if plot_path not in expected_plot_paths:
+        if plot_path not in expected_plot_paths_set:
             raise Exception(
                 f"unexpected plot path: {plot_path}\nexpected:\n"
                 + "\n  ".join(map(str, expected_plot_paths))
             )
         i_plot += 1
-        if cfg.verbose or not sys.stdout.isatty():
-            print(f"[{i_plot / n_plots:.0%}] {line}")
+        if show_lines:
+            print(f"[{i_plot / n_plots:.0%}] {line.decode('utf-8')}")
         else:
-            print(f"\r[{i_plot / n_plots:.0%}] {i_plot}/{n_plots}", end="", flush=True)
-    if not cfg.verbose:
+            # Only update the counter when the percentage changes to limit the
+            # number of flushes for large numbers of plots
+            pct = 100 * i_plot // n_plots
+            if pct != last_pct:
+                sys.stdout.write(f"\r[{pct}%] {i_plot}/{n_plots}")
+                sys.stdout.flush()
+                last_pct = pct
+    if not cfg.verbose and progress_counter:
         print()
 
     return plot_paths
 
 
-def link_data_path(target_path: Path, cfg: RunConfig) -> None:
+def link_data_path(target_path: Path, work_path: Path, cfg: RunConfig) -> None:
     _name_ = "main.link_data_path"
     if not target_path.exists():
         raise Exception(f"data path not found: {target_path}")
-    link_path = Path("data")
-    if link_path.exists():
+    link_path = work_path / "data"
+    # Note: Unlike Path.exists, lexists also detects broken symlinks
+    if os.path.lexists(link_path):
         if not link_path.is_symlink():
             raise Exception(
                 f"data link path {link_path.resolve()} exists and is not a symlink"
@@ -162,17 +294,21 @@ def link_data_path(target_path: Path, cfg: RunConfig) -> None:
     link_path.symlink_to(target_path)
 
 
-def perform_dry_run(cmd_args_dry: List[str], cfg: RunConfig) -> List[str]:
+def perform_dry_run(
+    cmd_args_dry: List[str], work_path: Path, cfg: RunConfig
+) -> List[str]:
     """Perform a dry-run to obtain the number of plots to be created."""
     _name_ = "main.perform_dry_run"
     if cfg.verbose:
         print(
-            "perform dry run to determine expected plots:\n$ " + " ".join(cmd_args_dry)
+            "perform dry run to determine expected plots:\n$ "
+            + join_cmd_args(cmd_args_dry)
         )
     plots: List[str] = []
-    for line in run_cmd(cmd_args_dry, real_time=True):
+    # Note: The output is only parsed once the dry run has finished anyway
+    for line in run_cmd_bytes_bulk(cmd_args_dry, cwd=work_path):
         if cfg.debug:
-            print(f"DBG:{_name_}: {line}")
+            print(f"DBG:{_name_}: {line.decode('utf-8')}")
         plot = parse_line_for_plot_name(line, cfg)
         if plot:
             if cfg.debug:
@@ -183,15 +319,68 @@ def perform_dry_run(cmd_args_dry: List[str], cfg: RunConfig) -> List[str]:
     return plots
 
 
-def parse_line_for_plot_name(line: str, cfg: RunConfig) -> Optional[str]:
+def perform_dry_run_cached(
+    cmd_args_dry: List[str],
+    deps: Sequence[Path],
+    work_path: Path,
+    cfg: RunConfig,
+    data_path: Optional[Path] = None,
+) -> List[str]:
+    """Perform a dry-run unless its result is cached in the work dir.
+
+    The cache key comprises the command arguments and the data path as well as
+    the size and modification time of the files the result depends on
+    (``deps``), e.g., the executable and the input file, such that changes to
+    those invalidate it. Relative deps are resolved against the work dir, from
+    which pyflexplot is run. If a dep cannot be stat'ed, e.g., because the
+    input file is a template, the dry run is performed without caching.
+
+    """
+    _name_ = "main.perform_dry_run_cached"
+    key = hashlib.sha256()
+    for arg in cmd_args_dry:
+        key.update(arg.encode("utf-8") + b"\0")
+    if data_path:
+        key.update(f"data_path:{data_path.resolve()}\0".encode("utf-8"))
+    for path in deps:
+        path = work_path / path
+        try:
+            stat = path.stat()
+        except OSError:
+            if cfg.debug:
+                print(f"DBG:{_name_}: cannot stat {path}; skip dry run cache")
+            return perform_dry_run(cmd_args_dry, work_path, cfg)
+        key.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\0".encode("utf-8"))
+    cache_path = work_path / DRY_RUN_CACHE_DIR / f"{key.hexdigest()}.json"
+    try:
+        with open(cache_path) as f:
+            plots = json.load(f)["plots"]
+    except (OSError, ValueError, KeyError):
+        pass
+    else:
+        if cfg.verbose:
+            print(f"reuse result of previous dry run: {cache_path}")
+        return plots
+    plots = perform_dry_run(cmd_args_dry, work_path, cfg)
+    if cfg.debug:
+        print(f"DBG:{_name_}: cache result of dry run: {cache_path}")
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, "w") as f:
+        json.dump({"cmd_args": cmd_args_dry, "plots": plots}, f, indent=1)
+    return plots
+
+
+def parse_line_for_plot_name(line: bytes, cfg: RunConfig) -> Optional[str]:
     _name_ = "parse_line_for_plot_name"
-    expr = r"^[^ ]+ -> (?P<path>[^ ]+)$"
-    match = re.match(expr, line)
+    # Equivalent to matching r"^[^ ]+ -> (?P<path>[^ ]+)$", but cheaper
+    infile, sep, path = line.partition(PLOT_LINE_SEP)
+    match = bool(sep and infile and path) and b" " not in infile and b" " not in path
     if cfg.debug:
         print(
-            f"DBG:{_name_}: '{expr}' {'' if match else 'not '} matched by line '{line}'"
+            f"DBG:{_name_}: '<infile>{PLOT_LINE_SEP.decode()}<plot>'"
+            f" {'' if match else 'not '} matched by line '{line.decode('utf-8')}'"
         )
-    return match.group("path") if match else None
+    return path.decode("utf-8") if match else None
 
 
 def animate_diff_plots(
@@ -207,37 +396,49 @@ def animate_diff_plots(
         raise ValueError("missing diff plots to create composite diff plot")
     n_diffs = len(diff_plot_paths)
     anim_path = diffs_path / f"animated_diff_{n_diffs}x.gif"
-    cmd_args = (
-        [f"convert -delay {delay}"] + list(map(str, diff_plot_paths)) + [str(anim_path)]
-    )
     if cfg.verbose:
         print(f"create animation of {n_diffs} diff plots: {anim_path}")
-    if cfg.debug:
-        print(
-            f"DBG:{_name_}: create diff animation plot with following command:"
-            + ("\n$ " + " \\\n    ".join(cmd_args))
-        )
-    cmd_args = [sub_arg for arg in cmd_args for sub_arg in arg.split()]
-    try:
-        run_cmd(cmd_args)
-    # pylint: disable=W0703  # broad-except
-    except Exception as e:
-        raise Exception(f"error creating diff animation plot {anim_path}:\n{e}") from e
+    with image_list_args(diff_plot_paths) as path_args:
+        # Limit the memory used by IM, beyond which it uses disk cache instead
+        cmd_args = [
+            "convert",
+            *["-limit", "memory", "2GiB"],
+            *["-limit", "map", "4GiB"],
+            *["-delay", str(delay)],
+            *path_args,
+            str(anim_path),
+        ]
+        if cfg.debug:
+            print(
+                f"DBG:{_name_}: create diff animation plot with following command:"
+                + ("\n$ " + join_cmd_args(cmd_args, " \\\n    "))
+            )
+        try:
+            run_cmd(cmd_args)
+        # pylint: disable=W0703  # broad-except
+        except Exception as e:
+            raise Exception(
+                f"error creating diff animation plot {anim_path}:\n{e}"
+            ) from e
     return anim_path
 
 
-def zip_presets_infiles(plot_cfg) -> Iterator[Tuple[str, Optional[Path]]]:
-    infiles: Sequence[Optional[Path]]
+@lru_cache(maxsize=None)
+def zip_presets_infiles(
+    plot_cfg: PlotConfig,
+) -> Tuple[Tuple[str, Optional[Path]], ...]:
+    """Pair the presets and infiles of a plot config (cached)."""
+    infiles: Iterable[Optional[Path]]
     n_pre = len(plot_cfg.presets)
     n_in = len(plot_cfg.infiles)
     if n_in == 0:
-        infiles = [None] * n_pre
+        infiles = repeat(None, n_pre)
     elif n_in == 1:
-        infiles = [next(iter(plot_cfg.infiles))] * n_pre
+        infiles = repeat(plot_cfg.infiles[0], n_pre)
     elif n_in == n_pre:
         infiles = plot_cfg.infiles
     else:
         raise Exception(
             f"incompatible numbers of presets ({n_pre}) and infiles ({n_in})"
         )
-    return zip(plot_cfg.presets, infiles)
+    return tuple(zip(plot_cfg.presets, infiles))
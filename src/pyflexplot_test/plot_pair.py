@@ -2,14 +2,15 @@
 from __future__ import annotations
 
 # Standard library
-import filecmp
+import mmap
 import os
-import re
+import struct
+import subprocess
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from subprocess import PIPE
-from subprocess import Popen
 from typing import Iterator
 from typing import Optional
 from typing import Sequence
@@ -17,7 +18,17 @@ from typing import Union
 
 # Local
 from .config import RunConfig
+from .utils import image_list_args
+from .utils import join_cmd_args
 from .utils import run_cmd
+from .utils import run_cmd_bytes_bulk
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def as_path(path: Union[Path, str]) -> Path:
+    """Turn ``path`` into a ``Path`` unless it already is one."""
+    return path if isinstance(path, Path) else Path(path)
 
 
 class PlotPair:
@@ -27,6 +38,8 @@ class PlotPair:
         path2: Union[Path, str],
         base1: Optional[Union[Path, str]] = None,
         base2: Optional[Union[Path, str]] = None,
+        sizes: Optional[dict[tuple[Path, bool], tuple[int, int]]] = None,
+        shared_root: Optional[Path] = None,
     ) -> None:
         """Create an instance of ``PlotPair``.
 
@@ -47,28 +60,57 @@ class PlotPair:
 
             base2 (optional): Like ``base1`` but for ``path2``.
 
+            sizes (optional): Cache of image sizes by path and whether the
+                image is trimmed; may be shared among multiple pairs.
+
+            shared_root (optional): Common path of ``base1`` and ``base2``, if
+                already known (e.g., because it is shared among multiple pairs).
+
         """
-        self.path1: Path = Path(path1)
-        self.path2: Path = Path(path2)
-        self.base1: Path = Path(base1 or self.path1.root)
-        self.base2: Path = Path(base2 or self.path2.root)
-        shared_base1 = self.path1.relative_to(self.base1)
-        shared_base2 = self.path2.relative_to(self.base2)
-        if shared_base1 != shared_base2:
-            raise ValueError(
-                "inconsistent paths and bases; shared path components differ:"
-                f" {shared_base1} != {shared_base2}"
-            )
-        self.shared_base: Path = shared_base1
-        self.shared_root: Path = Path(os.path.commonpath([self.base1, self.base2]))
+        self.path1: Path = as_path(path1)
+        self.path2: Path = as_path(path2)
+        self.base1: Path = as_path(base1 or self.path1.root)
+        self.base2: Path = as_path(base2 or self.path2.root)
+        # Derived paths are only computed on demand
+        self._shared_base: Optional[Path] = None
+        self._shared_root: Optional[Path] = shared_root
+        self._rel_path1: Optional[Path] = None
+        self._rel_path2: Optional[Path] = None
+        self._sizes: dict[tuple[Path, bool], tuple[int, int]] = (
+            {} if sizes is None else sizes
+        )
+        self._is_identical: Optional[bool] = None
+
+    @property
+    def shared_base(self) -> Path:
+        if self._shared_base is None:
+            shared_base1 = self.path1.relative_to(self.base1)
+            shared_base2 = self.path2.relative_to(self.base2)
+            if shared_base1 != shared_base2:
+                raise ValueError(
+                    "inconsistent paths and bases; shared path components differ:"
+                    f" {shared_base1} != {shared_base2}"
+                )
+            self._shared_base = shared_base1
+        return self._shared_base
+
+    @property
+    def shared_root(self) -> Path:
+        if self._shared_root is None:
+            self._shared_root = Path(os.path.commonpath([self.base1, self.base2]))
+        return self._shared_root
 
     @property
     def rel_path1(self) -> Path:
-        return self.path1.relative_to(self.shared_root)
+        if self._rel_path1 is None:
+            self._rel_path1 = self.path1.relative_to(self.shared_root)
+        return self._rel_path1
 
     @property
     def rel_path2(self) -> Path:
-        return self.path2.relative_to(self.shared_root)
+        if self._rel_path2 is None:
+            self._rel_path2 = self.path2.relative_to(self.shared_root)
+        return self._rel_path2
 
     def create_diff(
         self,
@@ -79,7 +121,7 @@ class PlotPair:
         _name_ = f"{__name__}.{type(self).__name__}.create_diff"
         if cfg.debug:
             print(f"DBG:{_name_}: comparing pair {self.shared_base}")
-        if filecmp.cmp(self.path1, self.path2):
+        if self._identical():
             if cfg.verbose:
                 print(f"identical: {self.shared_base}")
             return None
@@ -91,8 +133,8 @@ class PlotPair:
                 diff_path = Path(diffs_path) / diff_path
             if raw:
                 # Add '-raw' before suffix, e.g., a.png -> a-raw.png
-                diff_path = diff_path.parent / Path(
-                    re.sub(r"(.\w+$)", r"-raw\1", diff_path.name)
+                diff_path = diff_path.with_name(
+                    f"{diff_path.stem}-raw{diff_path.suffix}"
                 )
             diff_path.parent.mkdir(parents=True, exist_ok=True)
             if self._equal_sized():
@@ -101,18 +143,25 @@ class PlotPair:
                 self._compare_unequal_sized(diff_path, cfg, raw)
             return diff_path
 
+    def _identical(self) -> bool:
+        """Determine whether the plot files have the same content."""
+        # Cache the result as pairs may be compared repeatedly (e.g., again as
+        # raw diffs for the composite diff plot)
+        if self._is_identical is None:
+            self._is_identical = fast_bytes_equal(self.path1, self.path2)
+        return self._is_identical
+
     def _compare_equal_sized(self, diff_path: Path, cfg: RunConfig, raw: bool) -> None:
         _name_ = f"{__name__}.{type(self).__name__}._compare_equal_sized"
         cmd_args = ["compare", str(self.path1), str(self.path2)]
         if raw:
-            cmd_args += ["-compose src -highlight-color red"]
+            cmd_args += ["-compose", "src", "-highlight-color", "red"]
         cmd_args += [str(diff_path)]
         if cfg.debug:
             print(
                 f"DBG:{_name_}: create diff plot with following command:\n$ "
-                + " \\\n    ".join(cmd_args)
+                + join_cmd_args(cmd_args, " \\\n    ")
             )
-        cmd_args = [sub_arg for arg in cmd_args for sub_arg in arg.split()]
         run_cmd(cmd_args)
 
     # pylint: disable=R0914  # too-many-locals (>15)
@@ -120,72 +169,60 @@ class PlotPair:
         self, diff_path: Path, cfg: RunConfig, raw: bool
     ) -> None:
         _name_ = f"{__name__}.{type(self).__name__}._compare_unequal_sized"
-        w1 = int(self._identify(self.path1, fmt="%[w]", trim=True))
-        w2 = int(self._identify(self.path2, fmt="%[w]", trim=True))
-        h1 = int(self._identify(self.path1, fmt="%[h]", trim=True))
-        h2 = int(self._identify(self.path2, fmt="%[h]", trim=True))
+        (w1, h1), (w2, h2) = self._get_sizes(trim=True)
         width = max(w1, w2)
         height = max(h1, h2)
         size = f"{width}x{height}"
         if cfg.debug:
             print(f"DBG:{_name_}: original sizes: ({w1}x{h1}), ({w2}x{h2})")
             print(f"DBG:{_name_}: target size: ({size})")
-        args_prep = (
-            f"-trim -resize {size} -background white -gravity north-west -extent {size}"
-            f" -bordercolor white -border 10"
-        )
-        args_path1 = f"( {args_prep} {str(self.path1)} )"
-        args_path2 = f"( {args_prep} {str(self.path2)} )"
-        cmd_prep = f"convert {args_path1} {args_path2} miff:-"
-        cmd_comp = "compare miff:-"
+        args_prep = [
+            "-trim",
+            *["-resize", size],
+            *["-background", "white"],
+            *["-gravity", "north-west"],
+            *["-extent", size],
+            *["-bordercolor", "white"],
+            *["-border", "10"],
+        ]
+        cmd_prep_args = ["convert"]
+        for path in [self.path1, self.path2]:
+            cmd_prep_args += ["(", *args_prep, str(path), ")"]
+        cmd_prep_args += ["miff:-"]
+        cmd_comp_args = ["compare", "miff:-"]
         if raw:
-            cmd_comp += " -compose src -highlight-color red"
-        cmd_comp += f" {diff_path}"
-        cmd = " | ".join([cmd_prep, cmd_comp])
+            cmd_comp_args += ["-compose", "src", "-highlight-color", "red"]
+        cmd_comp_args += [str(diff_path)]
+        cmd = " | ".join([join_cmd_args(cmd_prep_args), join_cmd_args(cmd_comp_args)])
         if cfg.debug:
             print(f"DBG:{_name_}: creating diff plot with following command:\n$ {cmd}")
-        with Popen(
-            cmd_comp.split(),
-            stdin=Popen(cmd_prep.split(), stdout=PIPE).stdout,
-            stdout=PIPE,
-        ) as p:
-            _, stderr = p.communicate()
-        if stderr:
+        prep = subprocess.run(cmd_prep_args, stdout=PIPE, stderr=PIPE, check=False)
+        if prep.returncode:
+            raise RuntimeError(
+                f"error running command '{cmd}':\n{prep.stderr.decode('ascii')}"
+            )
+        # Note: Exit status 1 of compare only indicates that the images differ
+        comp = subprocess.run(
+            cmd_comp_args, input=prep.stdout, stdout=PIPE, stderr=PIPE, check=False
+        )
+        if comp.returncode > 1:
             raise RuntimeError(
-                f"error running command '{cmd}':\n{stderr.decode('ascii')}"
+                f"error running command '{cmd}':\n{comp.stderr.decode('ascii')}"
             )
 
     def _equal_sized(self) -> bool:
         """Determine whether the images are of equal size."""
-        size1 = self._identify(self.path1, fmt="%[w]x%[h]")
-        size2 = self._identify(self.path2, fmt="%[w]x%[h]")
+        size1, size2 = self._get_sizes()
         return size1 == size2
 
-    @staticmethod
-    def _identify(path: Path, fmt: Optional[str] = None, trim: bool = False) -> str:
-        """Run IM's identify for ``path``."""
-        cmd_idfy = "identify"
-        if fmt is not None:
-            cmd_idfy += f" -format {fmt}"
-        if not trim:
-            cmd_idfy += f" {path}"
-            with Popen(cmd_idfy.split(), stdout=PIPE) as p:
-                stdout, _ = p.communicate()
-                return stdout.decode("ascii")
-        cmd_idfy += " miff:-"
-        cmd_trim = f"convert -trim {path} miff:-"
-        cmd = " | ".join([cmd_trim, cmd_idfy])
-        with Popen(
-            cmd_idfy.split(),
-            stdin=Popen(cmd_trim.split(), stdout=PIPE).stdout,
-            stdout=PIPE,
-        ) as p:
-            stdout, stderr = p.communicate()
-            if stderr:
-                raise RuntimeError(
-                    f"error running command '{cmd}':\n{stderr.decode('ascii')}"
-                )
-            return stdout.decode("ascii")
+    def _get_sizes(self, trim: bool = False) -> list[tuple[int, int]]:
+        """Get width and height of both images, running IM at most once."""
+        paths = [self.path1, self.path2]
+        missing = [path for path in paths if (path, trim) not in self._sizes]
+        if missing:
+            for path, size in identify_sizes(missing, trim=trim).items():
+                self._sizes[(path, trim)] = size
+        return [self._sizes[(path, trim)] for path in paths]
 
 
 class PlotPairSequence:
@@ -214,8 +251,22 @@ class PlotPairSequence:
             del_missing=True,
             sort_rel=sort,
         )
+        # Image sizes by path and whether the image is trimmed, shared by all
+        # pairs such that they can be determined for all at once
+        self.sizes: dict[tuple[Path, bool], tuple[int, int]] = {}
+        # Common path of the bases, which is the same for all pairs
+        shared_root: Optional[Path] = None
+        if base1 and base2:
+            shared_root = Path(os.path.commonpath([base1, base2]))
         self.pairs: list[PlotPair] = [
-            PlotPair(path1=old_path, path2=new_path, base1=base1, base2=base2)
+            PlotPair(
+                path1=old_path,
+                path2=new_path,
+                base1=base1,
+                base2=base2,
+                sizes=self.sizes,
+                shared_root=shared_root,
+            )
             for old_path, new_path in zip(paths1, paths2)
         ]
 
@@ -244,29 +295,71 @@ class PlotPairSequence:
             print("warning: no pairs of plots to create diff plots")
             return []
         print(f"compare {len(self)} pairs of plots")
+        self._prefetch_sizes(cfg)
         diff_paths: list[Path] = []
-        for pair in self:
-            try:
-                diff_path = pair.create_diff(diffs_path, cfg, raw=raw)
-            # pylint: disable=W0703  # broad-except
-            except Exception as e:
-                if not err_ok:
-                    raise Exception(
-                        f"error comparing {pair.rel_path1} and {pair.rel_path2}:\n{e}"
-                    ) from e
-                else:
-                    print("-" * 50, file=sys.stderr)
-                    traceback.print_exc()
-                    print("-" * 50, file=sys.stderr)
-                    print(
-                        "error during diff creation (see traceback above);"
-                        f" abort comparison of {pair.rel_path1} and {pair.rel_path2}",
-                        file=sys.stderr,
-                    )
-            if diff_path is not None:
-                diff_paths.append(diff_path)
+        # The pairs are independent and the work is done by IM subprocesses,
+        # so threads suffice to compare multiple pairs at once
+        with ThreadPoolExecutor(max_workers=max(1, cfg.num_procs)) as executor:
+            futures = [
+                executor.submit(pair.create_diff, diffs_path, cfg, raw=raw)
+                for pair in self
+            ]
+            # Collect the results in order to keep the output deterministic
+            for pair, future in zip(self, futures):
+                try:
+                    diff_path = future.result()
+                # pylint: disable=W0703  # broad-except
+                except Exception as e:
+                    if not err_ok:
+                        # Only drop the pairs not yet started; the ones being
+                        # compared are still completed before leaving the
+                        # executor, which is fine as each takes only a few
+                        # short IM calls (unlike presets in create_plots)
+                        for future_i in futures:
+                            future_i.cancel()
+                        raise Exception(
+                            f"error comparing {pair.rel_path1} and {pair.rel_path2}"
+                            f":\n{e}"
+                        ) from e
+                    else:
+                        print("-" * 50, file=sys.stderr)
+                        traceback.print_exc()
+                        print("-" * 50, file=sys.stderr)
+                        print(
+                            "error during diff creation (see traceback above);"
+                            f" abort comparison of {pair.rel_path1} and"
+                            f" {pair.rel_path2}",
+                            file=sys.stderr,
+                        )
+                        continue
+                if diff_path is not None:
+                    diff_paths.append(diff_path)
         return diff_paths
 
+    def _prefetch_sizes(self, cfg: RunConfig) -> None:
+        """Determine the sizes of all plots at once instead of pair by pair."""
+        _name_ = f"{__name__}.{type(self).__name__}._prefetch_sizes"
+        paths = [
+            path
+            for pair in self
+            for path in [pair.path1, pair.path2]
+            if (path, False) not in self.sizes
+        ]
+        if not paths:
+            return
+        if cfg.debug:
+            print(f"DBG:{_name_}: determine sizes of {len(paths)} plots")
+        try:
+            sizes = identify_sizes(paths)
+        # pylint: disable=W0703  # broad-except
+        except Exception as e:
+            # Not fatal because the sizes are otherwise determined pair by pair
+            if cfg.debug:
+                print(f"DBG:{_name_}: error determining sizes of plots:\n{e}")
+            return
+        for path, size in sizes.items():
+            self.sizes[(path, False)] = size
+
     def create_composite_diff(self, diffs_path: Path, cfg: RunConfig) -> Path:
         """Create composite difference plot for those pairs that differ.
 
@@ -281,26 +374,22 @@ class PlotPairSequence:
         if not diff_paths:
             raise Exception("missing diff plots to create composite diff plot")
         composite_path = diffs_path / f"composite_diff_{len(diff_paths)}x.png"
-        cmd_args = (
-            ["composite"]
-            + list(map(str, diff_paths))
-            + ["-compose src", str(composite_path)]
-        )
         if cfg.verbose:
             print(f"create composite of {len(diff_paths)} diff plots: {composite_path}")
-        if cfg.debug:
-            print(
-                f"DBG:{_name_}: create composite raw diff plot with following command:"
-                + ("\n$ " + " \\\n    ".join(cmd_args))
-            )
-        cmd_args = [sub_arg for arg in cmd_args for sub_arg in arg.split()]
-        try:
-            run_cmd(cmd_args)
-        # pylint: disable=W0703  # broad-except
-        except Exception as e:
-            raise Exception(
-                f"error creating composite diff plot {composite_path}:\n{e}"
-            ) from e
+        with image_list_args(diff_paths) as path_args:
+            cmd_args = ["composite", *path_args, "-compose", "src", str(composite_path)]
+            if cfg.debug:
+                print(
+                    f"DBG:{_name_}: create composite raw diff plot with following"
+                    " command:\n$ " + join_cmd_args(cmd_args, " \\\n    ")
+                )
+            try:
+                run_cmd(cmd_args)
+            # pylint: disable=W0703  # broad-except
+            except Exception as e:
+                raise Exception(
+                    f"error creating composite diff plot {composite_path}:\n{e}"
+                ) from e
         if cfg.verbose:
             print(f"remove {len(diff_paths)} raw diff plots")
         for path in diff_paths:
@@ -363,45 +452,157 @@ class PlotPairSequence:
 
         def subtract_base(paths: list[Path], base: Optional[Path]) -> list[Path]:
             if base is None:
-                return list(paths)
+                # Note: No copy needed as the paths are updated along with the
+                # relative paths, which are the same objects in this case
+                return paths
             return [path.relative_to(base) for path in paths]
 
-        # pylint: disable=R0913  # too-many-arguments (>5)
+        # Compute the relative paths and their sets only once for both
+        # directions; the sets remain valid because only paths missing in the
+        # other collection are ever deleted
+        rel_paths1 = subtract_base(paths1, base1)
+        rel_paths2 = subtract_base(paths2, base2)
+        rel_paths1_set = set(rel_paths1)
+        rel_paths2_set = set(rel_paths2)
+        if rel_paths1_set == rel_paths2_set and not sort_rel:
+            return ([], [])
+
+        # Warnings are collected and written at once in the end
+        warning_lines: list[str] = []
+
         def run(
             name1: str,
             paths1: list[Path],
-            base1: Optional[Path],
+            rel_paths1: list[Path],
             name2: str,
-            paths2: list[Path],
-            base2: Optional[Path],
+            rel_paths2_set: set[Path],
         ) -> list[Path]:
-            rel_paths1 = subtract_base(paths1, base1)
-            rel_paths2 = subtract_base(paths2, base2)
             missing2: list[Path] = []
-            for path1, rel_path1 in zip(list(paths1), list(rel_paths1)):
-                if rel_path1 in rel_paths2:
+            # Rebuild the paths in one pass instead of removing them one by one
+            kept: list[int] = []
+            for idx, rel_path1 in enumerate(rel_paths1):
+                if rel_path1 in rel_paths2_set:
+                    kept.append(idx)
                     continue
                 missing2.append(rel_path1)
                 msg = f"path from '{name1}' missing in '{name2}': {rel_path1}"
                 if err_action == "raise":
                     raise AssertionError(msg)
                 elif err_action == "warn":
-                    print(f"warning: {msg}", file=sys.stderr)
+                    warning_lines.append(f"warning: {msg}\n")
                 elif err_action is None:
                     # Do nothing
                     pass
-                if del_missing:
-                    paths1.remove(path1)
-                    rel_paths1.remove(rel_path1)
+                if not del_missing:
+                    kept.append(idx)
             if sort_rel:
-                paths1_sorted_by_rel = sorted(
-                    [(rel_path1, path1) for path1, rel_path1 in zip(paths1, rel_paths1)]
-                )
-                paths1.clear()
-                for _, path1 in paths1_sorted_by_rel:
-                    paths1.append(path1)
+                kept.sort(key=rel_paths1.__getitem__)
+            if del_missing or sort_rel:
+                # Note: Both lists may be the same object (if there's no base)
+                new_paths1 = [paths1[idx] for idx in kept]
+                rel_paths1[:] = [rel_paths1[idx] for idx in kept]
+                paths1[:] = new_paths1
             return missing2
 
-        missing1 = run("paths2", paths2, base2, "paths1", paths1, base1)
-        missing2 = run("paths1", paths1, base1, "paths2", paths2, base2)
+        missing1 = run("paths2", paths2, rel_paths2, "paths1", rel_paths1_set)
+        missing2 = run("paths1", paths1, rel_paths1, "paths2", rel_paths2_set)
+        if warning_lines:
+            sys.stderr.write("".join(warning_lines))
         return (missing1, missing2)
+
+
+def fast_bytes_equal(path1: Path, path2: Path, chunk_size: int = 2**16) -> bool:
+    """Compare the content of two files byte by byte.
+
+    The files are memory-mapped and compared chunk by chunk, which is done by
+    ``memcmp`` under the hood and stops at the first differing chunk.
+
+    Paths referring to the same file (e.g., via a hard or symbolic link) are
+    recognized as such from the file stats without reading the content.
+
+    """
+    stat1 = path1.stat()
+    stat2 = path2.stat()
+    if os.path.samestat(stat1, stat2):
+        return True
+    size = stat1.st_size
+    if stat2.st_size != size:
+        return False
+    if size == 0:
+        return True
+    with open(path1, "rb") as f1, open(path2, "rb") as f2:
+        mm1 = mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ)
+        mm2 = mmap.mmap(f2.fileno(), 0, access=mmap.ACCESS_READ)
+        with mm1, mm2:
+            for start in range(0, size, chunk_size):
+                stop = start + chunk_size
+                if mm1[start:stop] != mm2[start:stop]:
+                    return False
+    return True
+
+
+def identify_sizes(
+    paths: Sequence[Path], trim: bool = False, chunk_size: int = 1000
+) -> dict[Path, tuple[int, int]]:
+    """Determine the sizes of multiple images with one IM call per chunk.
+
+    If ``trim`` is true, the sizes are those of the images after trimming, for
+    which each image is trimmed separately in an image sequence of ``convert``.
+
+    Like for a single image, warnings written by IM to standard error are
+    ignored, and only the first frame is considered for multi-frame images.
+
+    """
+    # Note: The file name identifies the image of each line even if there are
+    # multiple frames per image; it comes first lest it contain spaces
+    fmt = r"%i %[w]x%[h]\n"
+    sizes: dict[Path, tuple[int, int]] = {}
+    if not trim:
+        # Read the sizes of PNG files directly from their header
+        for path in paths:
+            size = png_size(path)
+            if size is not None:
+                sizes[path] = size
+        paths = [path for path in paths if path not in sizes]
+    for idx in range(0, len(paths), chunk_size):
+        paths_i = paths[idx : idx + chunk_size]
+        if trim:
+            cmd_args = ["convert"]
+            for path in paths_i:
+                cmd_args += ["(", str(path), "-trim", ")"]
+            cmd_args += ["-format", fmt, "info:"]
+        else:
+            cmd_args = ["identify", "-ping", "-format", fmt]
+            cmd_args += list(map(str, paths_i))
+        sizes_by_name: dict[str, tuple[int, int]] = {}
+        for line in run_cmd_bytes_bulk(cmd_args):
+            name, _, size_str = line.decode("utf-8").rpartition(" ")
+            width, sep, height = size_str.partition("x")
+            if name and sep and name not in sizes_by_name:
+                sizes_by_name[name] = (int(width), int(height))
+        for path in paths_i:
+            try:
+                sizes[path] = sizes_by_name[str(path)]
+            except KeyError as e:
+                raise Exception(
+                    f"missing size of {path} in output of {cmd_args[0]}"
+                ) from e
+    return sizes
+
+
+def png_size(path: Path) -> Optional[tuple[int, int]]:
+    """Read width and height of a PNG image from its header, if it is one.
+
+    The IHDR chunk, which contains the size, must come first in a PNG file,
+    so the size is always found at the same position as two 4-byte integers.
+
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(24)
+    except OSError:
+        return None
+    if len(head) < 24 or head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", head[16:24])
+    return (width, height)
@@ -1,35 +1,214 @@
 """Some utilities."""
 # Standard library
+import hashlib
+import os
+import shlex
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Deque
+from typing import Dict
+from typing import Iterable
 from typing import Iterator
 from typing import List
+from typing import Optional
 from typing import overload
 from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Union
 
 # Third-party
 from typing_extensions import Literal
 
+# Number of seconds for which the tags of a remote repository are cached
+TAGS_CACHE_TTL = 300
 
-# pylint: disable=W0102  # dangerous-default-value
-def tmp_path(base: str, _time_stamp: List[int] = []) -> str:
+# Time stamp in temporary paths, which is the same throughout a run
+TMP_TIME_STAMP = int(time.time())
+
+
+def tmp_path(base: str) -> str:
     """Get a temporary path containing a time stamp."""
-    if not _time_stamp:
-        _time_stamp.append(int(time.time()))
-    return f"{base}{_time_stamp[0]}"
+    return f"{base}{TMP_TIME_STAMP}"
+
+
+def is_file_or_nonempty_dir(path: Path) -> bool:
+    """Check whether ``path`` is a file or a directory with any content.
+
+    Only the first directory entry is read, if any, instead of all of them.
+
+    """
+    try:
+        with os.scandir(path) as entries:
+            return next(entries, None) is not None
+    except FileNotFoundError:
+        return False
+    except NotADirectoryError:
+        return True
+
+
+def filter_existing(paths: Iterable[Path]) -> List[Path]:
+    """Return those of ``paths`` that exist, listing each directory only once.
+
+    Like ``os.path.lexists``, broken symlinks are considered to exist.
+
+    """
+    names_by_dir: Dict[Path, Set[str]] = {}
+    existing: List[Path] = []
+    for path in paths:
+        dir_path = path.parent
+        if dir_path not in names_by_dir:
+            try:
+                with os.scandir(dir_path) as entries:
+                    names_by_dir[dir_path] = {entry.name for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                names_by_dir[dir_path] = set()
+        if path.name in names_by_dir[dir_path]:
+            existing.append(path)
+    return existing
+
+
+def remove_in_background(path: Path) -> None:
+    """Move a file or directory out of the way and remove it in the background.
+
+    Renaming the directory is a single syscall, after which ``path`` can be
+    reused right away, while the actual removal, which may take a while for
+    large directories, happens in a thread that is completed before exit.
+
+    Stale directories left behind by an earlier run that was killed before
+    completing the removal are removed along with it, and errors during the
+    removal are reported as warnings.
+
+    """
+    # Note: Staying in the same directory ensures the same file system
+    stale_prefix = f"{path.name}.stale."
+    stale_path = path.with_name(f"{stale_prefix}{uuid.uuid4().hex}")
+    try:
+        os.rename(path, stale_path)
+    except OSError:
+        # E.g., parent directory not writable; fall back to in-place removal
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+        return
+    with os.scandir(path.parent) as entries:
+        stale_entries = [
+            entry for entry in entries if entry.name.startswith(stale_prefix)
+        ]
+    stale_dir_paths: List[Path] = []
+    for entry in stale_entries:
+        if entry.is_dir(follow_symlinks=False):
+            stale_dir_paths.append(Path(entry.path))
+        else:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+    if stale_dir_paths:
+        threading.Thread(target=_remove_trees, args=(stale_dir_paths,)).start()
+
+
+def _remove_trees(paths: Sequence[Path]) -> None:
+    for path in paths:
+        shutil.rmtree(path, onerror=_warn_rmtree_error)
+
+
+def _warn_rmtree_error(func, path, exc_info) -> None:
+    # Note: Another run may be removing the same stale directory concurrently
+    if not issubclass(exc_info[0], FileNotFoundError):
+        print(f"warning: error removing {path}: {exc_info[1]}", file=sys.stderr)
+
+
+def join_cmd_args(args: Sequence[str], sep: str = " ") -> str:
+    """Join command arguments, quoted as necessary, for display."""
+    return sep.join(map(shlex.quote, args))
+
+
+@contextmanager
+def image_list_args(
+    paths: Sequence[Path], max_args_len: int = 2**17
+) -> Iterator[List[str]]:
+    """Pass many image paths to IM via a file list if they are too long.
+
+    If the paths are too long in total to be passed as arguments, they are
+    written to a temporary file, which is passed to IM as "@<file>" instead.
+    Otherwise, the paths are passed as is because reading file lists may be
+    disabled by the IM security policy.
+
+    """
+    args = list(map(str, paths))
+    if sum(len(arg) + 1 for arg in args) <= max_args_len:
+        yield args
+        return
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+        f.write("".join(f'"{arg}"\n' for arg in args))
+        f.flush()
+        yield [f"@{f.name}"]
+
+
+class CmdGroup:
+    """Group of concurrently run commands that can be terminated together.
+
+    Commands added after the group has been terminated are terminated right
+    away, such that a command started concurrently cannot slip through.
+
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._procs: "List[subprocess.Popen[bytes]]" = []
+        self.terminated = False
+
+    def add(self, proc: "subprocess.Popen[bytes]") -> None:
+        with self._lock:
+            self._procs.append(proc)
+            if self.terminated:
+                proc.terminate()
+
+    def terminate(self) -> None:
+        with self._lock:
+            self.terminated = True
+            for proc in self._procs:
+                if proc.poll() is None:
+                    proc.terminate()
 
 
 @overload
-def run_cmd(args: Sequence[str], real_time: Literal[False] = False) -> List[str]:
+def run_cmd(
+    args: Sequence[str],
+    real_time: Literal[False] = False,
+    *,
+    cwd: Optional[Union[Path, str]] = None,
+) -> List[str]:
     ...
 
 
 @overload
-def run_cmd(args: Sequence[str], real_time: Literal[True]) -> Iterator[str]:
+def run_cmd(
+    args: Sequence[str],
+    real_time: Literal[True],
+    *,
+    cwd: Optional[Union[Path, str]] = None,
+) -> Iterator[str]:
     ...
 
 
-def run_cmd(args: Sequence[str], real_time: bool = False):
+def run_cmd(
+    args: Sequence[str],
+    real_time: bool = False,
+    *,
+    cwd: Optional[Union[Path, str]] = None,
+):
     """Run a command and yield the standard output line by line.
 
     By default, the standard output is collected and returned after the command
@@ -43,6 +222,9 @@ def run_cmd(args: Sequence[str], real_time: bool = False):
         real_time (optional): Yield standard output line by line in real time
             instead of returning them together in the end.
 
+        cwd (optional): Working directory in which the command is run; defaults
+            to the current working directory.
+
     Returns:
         List of lines of standard output if ``real_time`` is false.
 
@@ -50,48 +232,157 @@ def run_cmd(args: Sequence[str], real_time: bool = False):
 
     """
 
-    def raise_if_err(returncode: int, stderr: List[str]) -> None:
-        if returncode:
-            raise RuntimeError(
-                f"error ({returncode}) running command '{' '.join(args)}':\n"
-                + "".join(stderr)
-            )
-
-    def _run_cmd_real_time(proc: subprocess.Popen) -> Iterator[str]:
-        assert proc.stdout is not None  # mypy
-        for raw_line in iter(proc.stdout.readline, b""):
-            line = raw_line.decode("utf-8").strip()
-            yield line
-        proc.wait()
-        assert proc.stderr is not None  # mypy
-        stderr = [raw_line.decode("utf-8") for raw_line in proc.stderr]
-        raise_if_err(proc.returncode, stderr)
-
-    # pylint: disable=R1732  # consider-using-with
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if real_time:
-        return _run_cmd_real_time(proc)
+        return (raw_line.decode("utf-8") for raw_line in run_cmd_bytes(args, cwd=cwd))
+    # pylint: disable=R1732  # consider-using-with
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
+    )
     raw_stdout, raw_stderr = proc.communicate()
-    stdout = list(map(str.strip, raw_stdout.decode("utf-8").split("\n")))
-    stderr = list(map(str.strip, raw_stderr.decode("utf-8").split("\n")))
-    if stderr == [""]:
-        stderr = []
-    raise_if_err(int(bool(stderr)), stderr)
+    stdout = [line.strip() for line in raw_stdout.decode("utf-8").splitlines()]
+    stderr = raw_stderr.decode("utf-8").splitlines(keepends=True)
+    _raise_if_cmd_err(args, int(bool(stderr)), stderr)
     return stdout
 
 
-def git_get_remote_tags(repo: str) -> List[str]:
-    """Get tags from remote git repository, sorted as version numbers."""
-    cmd_args = ["git", "ls-remote", "--tags", "--sort=version:refname", repo]
-    tags: List[str] = []
-    for line in run_cmd(cmd_args, real_time=True):
+def run_cmd_bytes(
+    args: Sequence[str],
+    *,
+    cwd: Optional[Union[Path, str]] = None,
+    group: Optional[CmdGroup] = None,
+) -> Iterator[bytes]:
+    """Run a command and yield the standard output line by line as raw bytes.
+
+    Like ``run_cmd`` with ``real_time=True``, but the lines are only stripped,
+    not decoded, such that callers only need to decode the lines they use.
+
+    The command is added to ``group``, if any, such that it can be terminated
+    from another thread, in which case an error is raised as usual.
+
+    """
+    # pylint: disable=R1732  # consider-using-with
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
+    )
+    if group is not None:
+        group.add(proc)
+    assert proc.stdout is not None  # mypy
+    assert proc.stderr is not None  # mypy
+    # Drain stderr concurrently lest the command block once the pipe is full,
+    # retaining only the last lines for the error message
+    stderr_lines: Deque[bytes] = deque(maxlen=1000)
+    stderr_thread = threading.Thread(
+        target=stderr_lines.extend, args=(proc.stderr,), daemon=True
+    )
+    stderr_thread.start()
+    # Read whatever output is available in chunks rather than line by line
+    fd = proc.stdout.fileno()
+    buffer = b""
+    while True:
+        chunk = os.read(fd, 2**16)
+        if not chunk:
+            break
+        *raw_lines, buffer = (buffer + chunk).split(b"\n")
+        for raw_line in raw_lines:
+            yield raw_line.strip()
+    if buffer:
+        yield buffer.strip()
+    proc.wait()
+    stderr_thread.join()
+    stderr = [raw_line.decode("utf-8") for raw_line in stderr_lines]
+    _raise_if_cmd_err(args, proc.returncode, stderr)
+
+
+def run_cmd_bytes_bulk(
+    args: Sequence[str], *, cwd: Optional[Union[Path, str]] = None
+) -> List[bytes]:
+    """Run a command and return the standard output lines as raw bytes.
+
+    Like ``run_cmd_bytes``, but the output is read at once after the command
+    has finished rather than line by line, which is cheaper for callers that
+    have no use for the lines in real time.
+
+    """
+    # pylint: disable=R1732  # consider-using-with
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
+    )
+    raw_stdout, raw_stderr = proc.communicate()
+    _raise_if_cmd_err(args, proc.returncode, [raw_stderr.decode("utf-8")])
+    return [raw_line.strip() for raw_line in raw_stdout.splitlines()]
+
+
+def _raise_if_cmd_err(args: Sequence[str], returncode: int, stderr: List[str]) -> None:
+    if returncode:
+        raise RuntimeError(
+            f"error ({returncode}) running command '{' '.join(args)}':\n"
+            + "".join(stderr)
+        )
+
+
+def git_get_remote_tags(repo: str, refresh: bool = False) -> List[str]:
+    """Get tags from remote git repository, sorted as version numbers.
+
+    The tags are cached for the lifetime of the process, as well as on disk
+    for ``TAGS_CACHE_TTL`` seconds to avoid contacting the remote repeatedly in
+    quick succession across runs, unless ``refresh``. If the cache directory
+    cannot be determined, the tags are only cached for the process.
+
+    """
+    if refresh:
+        _git_get_remote_tags_cached.cache_clear()
+    # Return a new list such that callers may modify it without affecting the cache
+    return list(_git_get_remote_tags_cached(repo, refresh))
+
+
+@lru_cache(maxsize=None)
+def _git_get_remote_tags_cached(repo: str, refresh: bool) -> Tuple[str, ...]:
+    repo_hash = hashlib.sha256(repo.encode()).hexdigest()
+    cache_path: Optional[Path]
+    try:
+        cache_path = get_cache_dir() / "tags" / f"{repo_hash}.txt"
+    except (KeyError, RuntimeError):
+        # Home directory cannot be determined, e.g., in some containers
+        cache_path = None
+    if cache_path is not None and not refresh:
         try:
-            # Format: "<hash>\t<refs/tags/tag>"
-            _, tag = line.split("\trefs/tags/")
-        except ValueError:
-            continue
-        if not tag.endswith("^{}"):
-            tags.append(tag)
+            if time.time() - cache_path.stat().st_mtime < TAGS_CACHE_TTL:
+                tags = cache_path.read_text().split()
+                if tags:
+                    return tuple(tags)
+        except OSError:
+            pass
+    # Note: Option --refs omits the peeled tags ("<tag>^{}")
+    cmd_args = ["git", "ls-remote", "--tags", "--refs", "--sort=version:refname", repo]
+    tags = []
+    # Parse the raw lines and only decode the tag names
+    for line in run_cmd_bytes(cmd_args):
+        # Format: "<hash>\t<refs/tags/tag>"
+        _, sep, tag = line.partition(b"\trefs/tags/")
+        if sep and tag:
+            tags.append(tag.decode("utf-8"))
     if not tags:
         raise Exception(f"no tags found for repo: {repo}")
-    return tags
+    if cache_path is None:
+        return tuple(tags)
+    try:
+        # Write to a temporary file first such that the cache is never partial
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_cache_path = cache_path.with_name(f"{cache_path.name}.{uuid.uuid4().hex}")
+        tmp_cache_path.write_text("\n".join(tags) + "\n")
+        os.replace(tmp_cache_path, cache_path)
+    except OSError:
+        # Caching is optional
+        pass
+    return tuple(tags)
+
+
+def get_cache_dir() -> Path:
+    """Get the directory where data are cached across runs.
+
+    Like ``Path.home``, raise ``KeyError`` or ``RuntimeError`` if neither
+    ``$XDG_CACHE_HOME`` is set nor the home directory can be determined.
+
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "pyflexplot_test"